@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import bisect
 import dataclasses as dc
 import enum
 import math
+import re
+import sys
 import typing as t
 
 from colored import Fore, Style
@@ -13,22 +16,10 @@ class CharType(enum.IntEnum):
     WORD = 1
     OTHER = 2
 
-    @staticmethod
-    def get(source: str, position: int) -> CharType:
-        if 0 < position < len(source) - 1 and source[position - 1] == "[" and source[position + 1] == "]":
-            # Anything between brackets is considered word.
-            return CharType.WORD
-        char = source[position]
-        if char.isspace():
-            return CharType.WHITESPACE
-        if char.isalnum() or char == "_":
-            return CharType.WORD
-        return CharType.OTHER
-
 
 class Block(enum.IntEnum):
     START = 0
-    END = 0
+    END = 1
 
 
 TokenType = t.Union[CharType, t.Tuple[Block, int]]
@@ -36,52 +27,56 @@ TokenType = t.Union[CharType, t.Tuple[Block, int]]
 T = t.TypeVar("T")
 
 
-@dc.dataclass
+@dc.dataclass(slots=True)
 class Token:
     source: str
     start: int
     end: int
     t: TokenType
+    # Interned lowercase text, so that comparing equal texts is an identity check.
+    lower: str = dc.field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.lower = sys.intern(self.text().lower())
 
     def text(self) -> str:
         return self.source[self.start : self.end]
 
     def insert_score(self, previous_is_same: bool) -> float:
-        add = 1.0 if isinstance(self, tuple) and self[0] == Block.END else 0.0
+        # Inserting end of a block costs extra.
+        add = 1.0 if isinstance(self.t, tuple) and self.t[0] == Block.END else 0.0
         if previous_is_same:
             return 0.3 + add
         return 0.7 + add
 
-    def mutation_score(self, other: Token) -> float:
-        if self.t != other.t:
-            return 100.0
-        if isinstance(self.t, tuple) and isinstance(other.t, tuple):
-            return abs(self.t[1] - other.t[1])
-        return 0.0 if self.text().lower() == other.text().lower() else 1
-
     def __repr__(self) -> str:
         return f"{self.text()} {self.t} {self.start} {self.end}"
 
 
+# Runs of characters of the same CharType: word characters (\w), whitespace and anything else. Single
+# character between brackets (like `x` in `[x]`) is a word character too, so a run of other characters
+# ends right after the opening bracket and the word starts with that character.
+TOKEN_RE = re.compile(
+    r"(?s)(?P<WORD>(?:\w|(?<=\[).(?=\]))+)"
+    r"|(?P<WHITESPACE>\s+)"
+    r"|(?P<OTHER>(?:[^\w\s\[]|\[(?!.\]))+(?:\[(?=.\]))?|\[(?=.\]))"
+)
+
+
 def token_parser(source: str) -> t.Iterable[Token]:
-    position = 0
     prev_indentation = 0
-    while position < len(source):
-        c_type = CharType.get(source, position)
-        start_position = position
-        while position < len(source) and c_type == CharType.get(source, position):
-            position += 1
+    for match in TOKEN_RE.finditer(source):
+        c_type = CharType[t.cast(str, match.lastgroup)]
+        position = match.end()
         token: Token = Token(
             source,
-            start_position,
+            match.start(),
             position,
             c_type,
         )
         if c_type == CharType.WHITESPACE:
-            whitespace_text = token.text()
-            current_indentation = (
-                len(whitespace_text.split("\n")[-1]) if "\n" in whitespace_text else prev_indentation
-            )
+            newline = source.rfind("\n", token.start, position)
+            current_indentation = position - newline - 1 if newline >= 0 else prev_indentation
             if current_indentation != prev_indentation:
                 yield Token(
                     source,
@@ -105,195 +100,509 @@ class Operation(enum.IntEnum):
 
 AlignmentOperation = t.Tuple[T, T] | t.Tuple[T, None] | t.Tuple[None, T]
 
+Alignment = t.List[AlignmentOperation[Token]]
 
-class PathList:
-    def __init__(self, payload: AlignmentOperation[Token], previous: None | PathList) -> None:
-        self.payload = payload
-        self.previous = previous
-
-    def extract_path(self) -> t.List[AlignmentOperation[Token]]:
-        out = []
-        this = self
-        out.append(self.payload)
-        while this.previous is not None:
-            this = this.previous
-            out.append(this.payload)
-        # out.reverse()
-        return out
-
-
-AlignmentData = t.Tuple[float, None | PathList]
-
-
-def unreachable() -> AlignmentData:
-    return (math.inf, None)
-
-
-def empty() -> AlignmentData:
-    return (0, None)
-
-
-@dc.dataclass
-class AlignmentState:
-    last_was_mutation: AlignmentData
-    last_was_insert_left: AlignmentData
-    last_was_insert_right: AlignmentData
 
-    def pick_best(
-        self,
-        payload: AlignmentOperation[Token],
-        mutation_score: float,
-        insert_left_score: float,
-        insert_right_score: float,
-    ) -> AlignmentData:
-        if insert_left_score < insert_right_score:
-            if insert_left_score < mutation_score:
-                score = insert_left_score
-                previous = self.last_was_insert_left[1]
+def mutation_cost_rows(left: t.List[Token], right: t.Iterable[Token]) -> t.Iterable[t.List[float]]:
+    """Mutation score of each left token against each right token.
+
+    Mutation costs 100 between different token types, otherwise 1 unless texts are equal (ignoring
+    case). Rows are built by copying the row for the right token's type and zeroing positions of equal
+    left tokens, which are looked up in an index, so cells are not compared one by one.
+    """
+    positions: t.Dict[t.Tuple[str, TokenType], t.List[int]] = {}
+    for index, token in enumerate(left):
+        positions.setdefault((token.lower, token.t), []).append(index)
+    type_rows: t.Dict[TokenType, t.List[float]] = {}
+    # Right tokens repeat a lot, so rows for the same text and type are reused (with bounded memory).
+    rows: t.Dict[t.Tuple[str, TokenType], t.List[float]] = {}
+    max_rows = max(1, FULL_DP_MAX_CELLS // max(1, len(left)))
+    for token in right:
+        key = (token.lower, token.t)
+        row = rows.get(key)
+        if row is None:
+            type_row = type_rows.get(token.t)
+            if type_row is None:
+                type_row = [1.0 if l.t == token.t else 100.0 for l in left]
+                if len(type_rows) < max_rows:
+                    type_rows[token.t] = type_row
+            row = type_row.copy()
+            for index in positions.get(key, ()):
+                row[index] = 0.0
+            if len(rows) < max_rows:
+                rows[key] = row
+        yield row
+
+
+# Above this number of DP cells, alignment is split into halves so that backpointers never need more
+# than this many cells (times 3 states) of memory.
+FULL_DP_MAX_CELLS = 1 << 22
+
+
+def best_state(mutation: float, insert_left: float, insert_right: float) -> int:
+    scores = (mutation, insert_left, insert_right)
+    # On ties, min keeps the first one, so inserts (right before left) are preferred.
+    return min((Operation.INSERT_RIGHT, Operation.INSERT_LEFT, Operation.MUTATION), key=scores.__getitem__)
+
+
+ScoreRows = t.Tuple[t.List[float], t.List[float], t.List[float]]
+
+
+def diagonal(r_index: int, left_length: int, right_length: int) -> int:
+    """Left index on the main diagonal of the DP grid for given right index"""
+    return round(r_index * left_length / right_length)
+
+
+def adaptive_band(left_length: int, right_length: int) -> int:
+    return max(32, int(0.1 * max(left_length, right_length)))
+
+
+def align_kernel(
+    costs: t.Iterable[t.List[float]],
+    left_same: t.List[float],
+    left_diff: t.List[float],
+    right_same: t.List[float],
+    right_diff: t.List[float],
+    start_state: int = Operation.MUTATION,
+    keep_back: bool = True,
+    band: int | None = None,
+) -> t.Tuple[bytearray, ScoreRows]:
+    """Fill the alignment DP from plain numbers.
+
+    `costs` yields, for each right token, mutation costs against all left tokens; `*_same` / `*_diff` are
+    insert costs of each token when the previous operation was / was not the same kind of insert.
+    `start_state` is the operation considered to precede the alignment.
+
+    Scores are kept as one row per state (last operation was mutation / insert left / insert right),
+    indexed by number of consumed left tokens. For each cell and state we only remember which state the
+    best path came from, in a single (state, right index, left index) grid:
+    `back[(state * (len(right) + 1) + right_index) * (len(left) + 1) + left_index]`. Returns the
+    backpointers together with the score rows after consuming all right tokens. Without `keep_back`,
+    only a single row of backpointers is kept (and overwritten), so memory is linear.
+
+    With `band`, only cells at most `band` left tokens away from the main diagonal are computed (others
+    stay unreachable), and each grid row holds just the `2 * band + 1` cells of the band, starting at
+    `diagonal(right_index) - band`. Requires `keep_back`.
+    """
+    inf = math.inf
+    insert_left_op = int(Operation.INSERT_LEFT)
+    insert_right_op = int(Operation.INSERT_RIGHT)
+    size = len(left_same) + 1
+    start = [inf, inf, inf]
+    start[start_state] = 0.0
+    mutation = [start[Operation.MUTATION]] + [inf] * (size - 1)
+    insert_left = [start[Operation.INSERT_LEFT]] + [inf] * (size - 1)
+    insert_right = [start[Operation.INSERT_RIGHT]] + [inf] * (size - 1)
+    # Backpointers start zeroed, which is Operation.MUTATION, so only other states are written.
+    nr = len(right_same)
+    width = size if band is None else 2 * band + 1
+    plane = width * (nr + 1) if keep_back else size
+    back = bytearray(3 * plane)
+    insert_left_plane = plane
+    insert_right_plane = 2 * plane
+    left_m = mutation[0]
+    left_il = insert_left[0]
+    left_ir = insert_right[0]
+    row = 0 if band is None else band
+    for l_index in range(1, size if band is None else min(size, band + 1)):
+        same = left_same[l_index - 1]
+        diff = left_diff[l_index - 1]
+        m = left_m + diff
+        il = left_il + same
+        ir = left_ir + diff
+        if il < ir:
+            if il < m:
+                left_il = il
+                back[insert_left_plane + row + l_index] = insert_left_op
             else:
-                score = mutation_score
-                previous = self.last_was_mutation[1]
+                left_il = m
+        elif ir < m:
+            left_il = ir
+            back[insert_left_plane + row + l_index] = insert_right_op
+        else:
+            left_il = m
+        left_m = inf
+        left_ir = inf
+        insert_left[l_index] = left_il
+
+    for r_index, row_costs in enumerate(costs, 1):
+        r_same = right_same[r_index - 1]
+        r_diff = right_diff[r_index - 1]
+        if band is None:
+            first, end = 0, size
+            row = r_index * size if keep_back else 0
         else:
-            if insert_right_score < mutation_score:
-                score = insert_right_score
-                previous = self.last_was_insert_right[1]
+            center = diagonal(r_index, size - 1, nr)
+            first, end = center - band, min(size, center + band + 1)
+            row = r_index * width - first
+        next_mutation = [inf] * size
+        next_insert_left = [inf] * size
+        next_insert_right = [inf] * size
+
+        if first > 0:
+            # Band doesn't reach the first column.
+            left_m = left_il = left_ir = inf
+            diag_m = mutation[first - 1]
+            diag_il = insert_left[first - 1]
+            diag_ir = insert_right[first - 1]
+        else:
+            first = 1
+            diag_m = mutation[0]
+            diag_il = insert_left[0]
+            diag_ir = insert_right[0]
+            m = diag_m + r_diff
+            il = diag_il + r_diff
+            ir = diag_ir + r_same
+            if il < ir:
+                if il < m:
+                    left_ir = il
+                    back[insert_right_plane + row] = insert_left_op
+                else:
+                    left_ir = m
+            elif ir < m:
+                left_ir = ir
+                back[insert_right_plane + row] = insert_right_op
             else:
-                score = mutation_score
-                previous = self.last_was_mutation[1]
-        return (score, PathList(payload, previous))
-
-    def extract_best(self) -> AlignmentData:
-        if self.last_was_mutation[0] < self.last_was_insert_left[0]:
-            if self.last_was_mutation[0] < self.last_was_insert_right[0]:
-                return self.last_was_mutation
-            return self.last_was_insert_right
-        if self.last_was_insert_left[0] < self.last_was_insert_right[0]:
-            return self.last_was_insert_left
-        return self.last_was_insert_right
-
-    def insert_left_score(self, l: Token) -> AlignmentData:
-        mutation_score = self.last_was_mutation[0] + l.insert_score(False)
-        insert_left_score = self.last_was_insert_left[0] + l.insert_score(True)
-        insert_right_score = self.last_was_insert_right[0] + l.insert_score(False)
-        return self.pick_best(
-            (l, None),
-            mutation_score,
-            insert_left_score,
-            insert_right_score,
+                left_ir = m
+            next_insert_right[0] = left_ir
+            left_m = inf
+            left_il = inf
+
+        for l_index in range(first, end):
+            cell = row + l_index
+            s = row_costs[l_index - 1]
+            m = diag_m + s
+            il = diag_il + s
+            ir = diag_ir + s
+            if il < ir:
+                if il < m:
+                    new_m = il
+                    back[cell] = insert_left_op
+                else:
+                    new_m = m
+            elif ir < m:
+                new_m = ir
+                back[cell] = insert_right_op
+            else:
+                new_m = m
+
+            same = left_same[l_index - 1]
+            diff = left_diff[l_index - 1]
+            m = left_m + diff
+            il = left_il + same
+            ir = left_ir + diff
+            if il < ir:
+                if il < m:
+                    new_il = il
+                    back[insert_left_plane + cell] = insert_left_op
+                else:
+                    new_il = m
+            elif ir < m:
+                new_il = ir
+                back[insert_left_plane + cell] = insert_right_op
+            else:
+                new_il = m
+
+            diag_m = mutation[l_index]
+            diag_il = insert_left[l_index]
+            diag_ir = insert_right[l_index]
+            m = diag_m + r_diff
+            il = diag_il + r_diff
+            ir = diag_ir + r_same
+            if il < ir:
+                if il < m:
+                    new_ir = il
+                    back[insert_right_plane + cell] = insert_left_op
+                else:
+                    new_ir = m
+            elif ir < m:
+                new_ir = ir
+                back[insert_right_plane + cell] = insert_right_op
+            else:
+                new_ir = m
+
+            next_mutation[l_index] = left_m = new_m
+            next_insert_left[l_index] = left_il = new_il
+            next_insert_right[l_index] = left_ir = new_ir
+        mutation = next_mutation
+        insert_left = next_insert_left
+        insert_right = next_insert_right
+
+    return back, (mutation, insert_left, insert_right)
+
+
+def align_kernel_backward(
+    costs: t.Iterable[t.List[float]],
+    left_same: t.List[float],
+    left_diff: t.List[float],
+    right_same: t.List[float],
+    right_diff: t.List[float],
+    end_state: int | None = None,
+) -> ScoreRows:
+    """Scores of the best way to finish the alignment, starting before all right tokens.
+
+    Same inputs as `align_kernel`, except that `costs` yields rows for right tokens from the last one
+    to the first one. Returned rows are indexed by number of consumed left tokens and state is the
+    operation preceding the rest of alignment. If `end_state` is set, alignment has to end with it.
+    """
+    inf = math.inf
+    size = len(left_same) + 1
+    end = [0.0, 0.0, 0.0] if end_state is None else [inf, inf, inf]
+    if end_state is not None:
+        end[end_state] = 0.0
+    mutation = [inf] * (size - 1) + [end[Operation.MUTATION]]
+    insert_left = [inf] * (size - 1) + [end[Operation.INSERT_LEFT]]
+    insert_right = [inf] * (size - 1) + [end[Operation.INSERT_RIGHT]]
+    for l_index in range(size - 2, -1, -1):
+        next_il = insert_left[l_index + 1]
+        mutation[l_index] = insert_right[l_index] = left_diff[l_index] + next_il
+        insert_left[l_index] = left_same[l_index] + next_il
+
+    for r_index, row_costs in zip(range(len(right_same) - 1, -1, -1), costs):
+        r_same = right_same[r_index]
+        r_diff = right_diff[r_index]
+        next_mutation = [inf] * size
+        next_insert_left = [inf] * size
+        next_insert_right = [inf] * size
+        down_ir = insert_right[-1]
+        next_mutation[-1] = next_insert_left[-1] = r_diff + down_ir
+        next_insert_right[-1] = r_same + down_ir
+        for l_index in range(size - 2, -1, -1):
+            m = row_costs[l_index] + mutation[l_index + 1]
+            next_il = next_insert_left[l_index + 1]
+            il_same = left_same[l_index] + next_il
+            il_diff = left_diff[l_index] + next_il
+            down_ir = insert_right[l_index]
+            ir_same = r_same + down_ir
+            ir_diff = r_diff + down_ir
+            next_mutation[l_index] = min(m, il_diff, ir_diff)
+            next_insert_left[l_index] = min(m, il_same, ir_diff)
+            next_insert_right[l_index] = min(m, il_diff, ir_same)
+        mutation = next_mutation
+        insert_left = next_insert_left
+        insert_right = next_insert_right
+    return mutation, insert_left, insert_right
+
+
+def traceback(
+    back: bytearray, state: int, left: t.List[Token], right: t.List[Token], band: int | None = None
+) -> Alignment:
+    """Extract path from `align_kernel` backpointers, from the last operation to the first one"""
+    out: Alignment = []
+    l_index = len(left)
+    r_index = len(right)
+    while l_index > 0 or r_index > 0:
+        if band is None:
+            cell = (state * (len(right) + 1) + r_index) * (len(left) + 1) + l_index
+        else:
+            row = (state * (len(right) + 1) + r_index) * (2 * band + 1)
+            cell = row + l_index - diagonal(r_index, len(left), len(right)) + band
+        previous_state = back[cell]
+        if state == Operation.MUTATION:
+            l_index -= 1
+            r_index -= 1
+            out.append((left[l_index], right[r_index]))
+        elif state == Operation.INSERT_LEFT:
+            l_index -= 1
+            out.append((left[l_index], None))
+        else:
+            r_index -= 1
+            out.append((None, right[r_index]))
+        state = previous_state
+    return out
+
+
+def out_of_band_inserts(left_length: int, right_length: int, band: int) -> float:
+    """Lower bound of the number of inserts in any alignment leaving the band.
+
+    Alignment through a cell with `l_index` left and `r_index` right tokens consumed needs at least
+    `|l_index - r_index| + |(left_length - l_index) - (right_length - r_index)|` inserts. That is
+    convex in `l_index` and minimal between `low` and `high`, so in each row only the cells right
+    outside of the band, or the closest ones to the minimum, are checked.
+    """
+    length_diff = left_length - right_length
+    best = math.inf
+    for r_index in range(right_length + 1):
+        center = diagonal(r_index, left_length, right_length)
+        low = r_index + min(0, length_diff)
+        high = r_index + max(0, length_diff)
+        candidates = []
+        if center - band - 1 >= 0:
+            candidates.append(min(center - band - 1, high))
+        if center + band + 1 <= left_length:
+            candidates.append(max(center + band + 1, low))
+        for l_index in candidates:
+            best = min(best, abs(l_index - r_index) + abs(length_diff - l_index + r_index))
+    return best
+
+
+def joined(tokens: t.List[Token], index: int) -> bool:
+    """True if there is no whitespace between tokens at `index - 1` and `index`"""
+    return 0 < index < len(tokens) and tokens[index - 1].end == tokens[index].start
+
+
+def common_affixes(left: t.List[Token], right: t.List[Token]) -> t.Tuple[int, int]:
+    """Lengths of common prefix and suffix (not overlapping) of tokens with zero mutation cost.
+
+    Affixes end at whitespace (or ends of texts) in both texts, so that part of a word (e.g. `#` of a
+    tag next to an inserted one) is not matched on its own.
+
+    >>> inserted = "\\n".join(pretty_alignment(align_texts("fix #a #b", "fix #a #g #b")))
+    >>> inserted.replace(Fore.green, "<").replace(Style.reset, ">")
+    'fix #a <#><g> #b'
+    >>> removed = "\\n".join(pretty_alignment(align_texts("fix #a #g #b", "fix #a #b")))
+    >>> removed.replace(Fore.red + Style.strikeout, "<").replace(Style.reset, ">")
+    'fix #a< ><#><g> #b'
+    """
+    limit = min(len(left), len(right))
+    prefix = 0
+    while prefix < limit and left[prefix].lower == right[prefix].lower and left[prefix].t == right[prefix].t:
+        prefix += 1
+    while prefix > 0 and (joined(left, prefix) or joined(right, prefix)):
+        prefix -= 1
+    suffix = 0
+    while (
+        suffix < limit - prefix
+        and left[-1 - suffix].lower == right[-1 - suffix].lower
+        and left[-1 - suffix].t == right[-1 - suffix].t
+    ):
+        suffix += 1
+    while suffix > 0 and (joined(left, len(left) - suffix) or joined(right, len(right) - suffix)):
+        suffix -= 1
+    return prefix, suffix
+
+
+def align(left: t.List[Token], right: t.List[Token], band: int | None = None) -> Alignment:
+    """Returns path from the last operation to the first one.
+
+    Common prefix and suffix are matched directly and only the middle part is aligned.
+
+    With `band` (see `adaptive_band`), only cells near the main diagonal are evaluated first, which is
+    much faster for similar texts. The banded path is used only if it's cheaper than the lower bound
+    of cost of any path leaving the band (see `out_of_band_inserts`), so it's the same path as the
+    full alignment would find. Otherwise the full alignment is computed.
+
+    Inputs that don't fit into FULL_DP_MAX_CELLS are split in Hirschberg fashion: the middle right
+    token row is scored from both ends in linear memory, the alignment is cut at the best crossing
+    (position and state) and both halves are aligned separately.
+    """
+    prefix, suffix = common_affixes(left, right)
+    if prefix or suffix:
+        left_end = len(left) - suffix
+        right_end = len(right) - suffix
+        return [
+            *zip(reversed(left[left_end:]), reversed(right[right_end:])),
+            *align(left[prefix:left_end], right[prefix:right_end], band),
+            *zip(reversed(left[:prefix]), reversed(right[:prefix])),
+        ]
+
+    left_same = [l.insert_score(True) for l in left]
+    left_diff = [l.insert_score(False) for l in left]
+    right_same = [r.insert_score(True) for r in right]
+    right_diff = [r.insert_score(False) for r in right]
+    out: Alignment = []
+
+    def costs(l_start: int, l_end: int, r_indices: t.Iterable[int]) -> t.Iterable[t.List[float]]:
+        return mutation_cost_rows(left[l_start:l_end], (right[r] for r in r_indices))
+
+    if band is not None and right and 2 * band < len(left):
+        back, rows = align_kernel(
+            costs(0, len(left), range(len(right))), left_same, left_diff, right_same, right_diff, band=band
         )
-
-    def insert_right_score(self, r: Token) -> AlignmentData:
-        mutation_score = self.last_was_mutation[0] + r.insert_score(False)
-        insert_left_score = self.last_was_insert_left[0] + r.insert_score(False)
-        insert_right_score = self.last_was_insert_right[0] + r.insert_score(True)
-        return self.pick_best(
-            (None, r),
-            mutation_score,
-            insert_left_score,
-            insert_right_score,
+        finals = [row[-1] for row in rows]
+        # Every insert costs at least `min_insert` and mutations are not negative. Small margin covers
+        # rounding of the summed scores.
+        min_insert = min(min(left_same), min(right_same))
+        if min(finals) + 1e-6 < min_insert * out_of_band_inserts(len(left), len(right), band):
+            return traceback(back, best_state(*finals), left, right, band)
+
+    def solve(
+        l_start: int, l_end: int, r_start: int, r_end: int, start_state: int, end_state: int | None
+    ) -> None:
+        if r_end - r_start <= 1 or (l_end - l_start + 1) * (r_end - r_start + 1) <= FULL_DP_MAX_CELLS:
+            back, rows = align_kernel(
+                costs(l_start, l_end, range(r_start, r_end)),
+                left_same[l_start:l_end],
+                left_diff[l_start:l_end],
+                right_same[r_start:r_end],
+                right_diff[r_start:r_end],
+                start_state,
+            )
+            state = best_state(*(row[-1] for row in rows)) if end_state is None else end_state
+            out.extend(reversed(traceback(back, state, left[l_start:l_end], right[r_start:r_end])))
+            return
+        r_mid = (r_start + r_end) // 2
+        _, forward = align_kernel(
+            costs(l_start, l_end, range(r_start, r_mid)),
+            left_same[l_start:l_end],
+            left_diff[l_start:l_end],
+            right_same[r_start:r_mid],
+            right_diff[r_start:r_mid],
+            start_state,
+            keep_back=False,
         )
-
-    def mutation_score(self, l: Token, r: Token) -> AlignmentData:
-        s = l.mutation_score(r)
-        mutation_score = self.last_was_mutation[0] + s
-        insert_left_score = self.last_was_insert_left[0] + s
-        insert_right_score = self.last_was_insert_right[0] + s
-        return self.pick_best(
-            (l, r),
-            mutation_score,
-            insert_left_score,
-            insert_right_score,
+        backward = align_kernel_backward(
+            costs(l_start, l_end, range(r_end - 1, r_mid - 1, -1)),
+            left_same[l_start:l_end],
+            left_diff[l_start:l_end],
+            right_same[r_mid:r_end],
+            right_diff[r_mid:r_end],
+            end_state,
         )
-
-
-AlignmentLineDS = t.List[AlignmentState]
-
-Alignment = t.List[AlignmentOperation[Token]]
-
-
-def align(left: t.List[Token], right: t.List[Token]) -> Alignment:
-    current = []
-    current.append(AlignmentState(empty(), unreachable(), unreachable()))
-    for l in left:
-        prev = current[-1]
-        current.append(AlignmentState(unreachable(), prev.insert_left_score(l), unreachable()))
-    for r in right:
-        next_row = []
-        prev = current[0]
-        next_row.append(AlignmentState(unreachable(), unreachable(), prev.insert_right_score(r)))
-        for l_index, l in enumerate(left):
-            l_index += 1
-            next_row.append(
-                AlignmentState(
-                    current[l_index - 1].mutation_score(l, r),
-                    next_row[l_index - 1].insert_left_score(l),
-                    current[l_index].insert_right_score(r),
-                )
-            )
-        current = next_row
-    ret = current[-1].extract_best()[1]
-    if ret is None:
-        return []
-    return ret.extract_path()
+        best = math.inf
+        split = (0, int(start_state))
+        for state, (forward_row, backward_row) in enumerate(zip(forward, backward)):
+            for l_index, (f, b) in enumerate(zip(forward_row, backward_row)):
+                if f + b < best:
+                    best = f + b
+                    split = (l_index, state)
+        l_mid = l_start + split[0]
+        solve(l_start, l_mid, r_start, r_mid, start_state, split[1])
+        solve(l_mid, l_end, r_mid, r_end, split[1], end_state)
+
+    solve(0, len(left), 0, len(right), Operation.MUTATION, None)
+    out.reverse()
+    return out
 
 
 Color = t.Literal["red"] | t.Literal["green"]
 
 
 class ColoredString:
-    def __init__(
-        self,
-        data: str | None = None,
-        color: None | Color = None,
-        strike_through: bool = False,
-    ) -> None:
+    """Line of text with colored segments, kept as a flat list of already styled parts"""
+
+    __slots__ = ("_len", "_all_space", "_parts")
+
+    def __init__(self) -> None:
         self._len = 0
-        self._color: None | Color = color
-        self._payload: t.List[str | ColoredString] = []
-        self._strike_through = strike_through
-        if data is not None:
-            self.extend(data)
+        self._all_space = True
+        self._parts: t.List[str] = []
 
     def isspace(self) -> bool:
-        for x in self._payload:
-            if len(x) > 0 and not x.isspace():
-                return False
-        return self._len > 0
+        return self._all_space and self._len > 0
 
     def __len__(self) -> int:
         return self._len
 
-    def extend(self, data: str | ColoredString) -> ColoredString:
+    def extend(self, data: str, color: None | Color = None, strike_through: bool = False) -> ColoredString:
         self._len += len(data)
-        self._payload.append(data)
+        if self._all_space and data and not data.isspace():
+            self._all_space = False
+        if color is None and not strike_through:
+            self._parts.append(data)
+            return self
+        if color == "red":
+            self._parts.append(Fore.red)
+        elif color == "green":
+            self._parts.append(Fore.green)
+        if strike_through:
+            self._parts.append(Style.strikeout)
+        self._parts.append(data)
+        self._parts.append(Style.reset)
         return self
 
-    def strings(self) -> t.Iterable[str]:
-        for p in self._payload:
-            if isinstance(p, str):
-                yield p
-            else:
-                yield from p.strings()
-
-    def colored_strings(self) -> t.Iterable[str]:
-        styled = self._color is not None or self._strike_through
-        if self._color is not None:
-            if self._color == "red":
-                yield Fore.red
-            elif self._color == "green":
-                yield Fore.green
-        if self._strike_through:
-            yield Style.strikeout
-        for p in self._payload:
-            if isinstance(p, str):
-                yield p
-            else:
-                yield from p.colored_strings()
-        if styled:
-            yield Style.reset
-
     def __format__(self, _: str) -> str:
-        return "".join(self.colored_strings())
+        return "".join(self._parts)
 
 
 def pretty_alignment(alignment: Alignment) -> t.Iterable[str]:
@@ -303,13 +612,16 @@ def pretty_alignment(alignment: Alignment) -> t.Iterable[str]:
     def flush() -> t.Iterable[str]:
         nonlocal left_line
         nonlocal right_line
-        if f"{left_line}" != f"{right_line}":
+        # Render each line once; colors matter for the comparison (e.g. deleted whitespace).
+        left_str = f"{left_line}"
+        right_str = f"{right_line}"
+        if left_str != right_str:
             if not left_line.isspace():
-                yield f"{left_line}"
+                yield left_str
             if not right_line.isspace():
-                yield f"{right_line}"
+                yield right_str
         else:
-            yield f"{right_line}"
+            yield right_str
         left_line = ColoredString()
         right_line = ColoredString()
 
@@ -318,12 +630,12 @@ def pretty_alignment(alignment: Alignment) -> t.Iterable[str]:
         if left is not None and right is not None:
             left_text = left.text()
             right_text = right.text()
-            if left_text.lower() == right_text.lower():
+            if left.lower == right.lower:
                 left_line.extend(" " * len(left_text))
                 right_line.extend(right_text)
             else:
-                left_line.extend(ColoredString(left_text, "red"))
-                right_line.extend(ColoredString(right_text, "green"))
+                left_line.extend(left_text, "red")
+                right_line.extend(right_text, "green")
             left_len = len(left_text)
             right_len = len(right_text)
             if left_len < right_len:
@@ -336,12 +648,12 @@ def pretty_alignment(alignment: Alignment) -> t.Iterable[str]:
                 # Ignoring whitespace for left
                 if not prev_was_space:
                     left_line.extend(" ")
-                    right_line.extend(ColoredString(" ", "red", True))
+                    right_line.extend(" ", "red", True)
                 prev_was_space = True
             else:
                 text = left.text()
                 left_line.extend(" " * len(text))
-                right_line.extend(ColoredString(text, "red", True))
+                right_line.extend(text, "red", True)
                 prev_was_space = False
         elif right is not None and left is None:
             if right.t == CharType.WHITESPACE:
@@ -362,13 +674,15 @@ def pretty_alignment(alignment: Alignment) -> t.Iterable[str]:
             else:
                 text = right.text()
                 left_line.extend(" " * len(text))
-                right_line.extend(ColoredString(text, "green"))
+                right_line.extend(text, "green")
                 prev_was_space = False
     yield from flush()
 
 
 def add_tokens(old_alignment: Alignment, left: t.List[Token], right: t.List[Token]) -> Alignment:
     new_alignment: Alignment = []
+    left_starts = [l.start for l in left]
+    right_starts = [r.start for r in right]
     left_index = 0
     right_index = 0
     left_position = None
@@ -376,14 +690,14 @@ def add_tokens(old_alignment: Alignment, left: t.List[Token], right: t.List[Toke
     for a_left, a_right in reversed(old_alignment):
         right_position = a_right if a_right is not None else right_position
         if right_position is not None:
-            while right_index < len(right) and right[right_index].start < right_position.start:
-                new_alignment.append((None, right[right_index]))
-                right_index += 1
-        left_position = a_left if left is not None else left_position
+            end = bisect.bisect_left(right_starts, right_position.start, right_index)
+            new_alignment.extend((None, r) for r in right[right_index:end])
+            right_index = end
+        left_position = a_left if a_left is not None else left_position
         if left_position is not None:
-            while left_index < len(left) and left[left_index].start < left_position.start:
-                new_alignment.append((left[left_index], None))
-                left_index += 1
+            end = bisect.bisect_left(left_starts, left_position.start, left_index)
+            new_alignment.extend((l, None) for l in left[left_index:end])
+            left_index = end
         new_alignment.append(t.cast(AlignmentOperation[Token], (a_left, a_right)))
 
     for r in right[right_index:]:
@@ -393,23 +707,35 @@ def add_tokens(old_alignment: Alignment, left: t.List[Token], right: t.List[Toke
     return new_alignment
 
 
-def align_texts(left_text: str, right_text: str) -> Alignment:
-    all_left_tokens = list(token_parser(left_text))
-    all_right_tokens = list(token_parser(right_text))
-    return add_tokens(
-        align(
-            [x for x in all_left_tokens if x.t != CharType.WHITESPACE],
-            [x for x in all_right_tokens if x.t != CharType.WHITESPACE],
-        ),
-        [x for x in all_left_tokens if x.t == CharType.WHITESPACE],
-        [x for x in all_right_tokens if x.t == CharType.WHITESPACE],
-    )
+def split_whitespace(tokens: t.Iterable[Token]) -> t.Tuple[t.List[Token], t.List[Token]]:
+    """Partition tokens into non-whitespace and whitespace ones, in one pass"""
+    words: t.List[Token] = []
+    whitespace: t.List[Token] = []
+    for token in tokens:
+        (whitespace if token.t == CharType.WHITESPACE else words).append(token)
+    return words, whitespace
 
 
-def main() -> None:
-    # pylint: disable=import-outside-toplevel
-    import sys
+# With `adaptive` set, `align_texts` of at least this many words (on either side) is banded.
+ADAPTIVE_BAND_MIN_WORDS = 1024
+
+
+def align_texts(
+    left_text: str, right_text: str, band: int | None = None, adaptive: bool = False
+) -> Alignment:
+    """Align tokens of two texts, see `align`.
 
+    With `adaptive` and no `band`, large texts use `adaptive_band`, which is much faster for similar
+    texts and gives the same alignment (falling back to the full one when the band is too narrow).
+    """
+    left_words, left_whitespace = split_whitespace(token_parser(left_text))
+    right_words, right_whitespace = split_whitespace(token_parser(right_text))
+    if adaptive and band is None and max(len(left_words), len(right_words)) >= ADAPTIVE_BAND_MIN_WORDS:
+        band = adaptive_band(len(left_words), len(right_words))
+    return add_tokens(align(left_words, right_words, band), left_whitespace, right_whitespace)
+
+
+def main() -> None:
     with open(sys.argv[1], "r", encoding="utf-8") as f:
         left_text = f.read()
     with open(sys.argv[2], "r", encoding="utf-8") as f:
@@ -2,15 +2,19 @@
 
 from __future__ import annotations
 
+import concurrent.futures
 import dataclasses as dc
 import datetime as dt
+import functools
+import heapq
+import json
 import math
+import operator
 import re
+import sys
 import typing as t
 import itertools as it
 
-import dataclasses_json as dj
-import more_itertools as mit
 from colored import Fore, Style
 
 import alignment as aln
@@ -22,23 +26,40 @@ HEADER_END = "TASK FILE HEADER END"
 
 EMPTY_TASK_STATE = "[ ]"
 
+# JSON (DB) representation of data is produced and read by hand written `to_dict` / `from_dict` methods,
+# with datetimes stored as timestamps.
+JsonDict = t.Dict[str, t.Any]
+# Shared encoder, json.dumps would create a new one for each call with non-default options. Data from
+# to_dict is a tree, so circular reference checks are not needed.
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, check_circular=False)
 
-def increase_counter(counter: str) -> str:
-    """Increase string counter. Assumes that the counter is valid integer number"""
-    number = int(counter)
-    number += 1
-    as_string = str(number)
-    if len(counter) > len(as_string):
-        diff = len(counter) - len(as_string)
-        return counter[:diff] + as_string
-    return as_string
 
+def encode_datetime(value: dt.datetime) -> float:
+    return value.timestamp()
 
-@dc.dataclass
-class Header(dj.DataClassJsonMixin):
+
+def decode_datetime(value: float) -> dt.datetime:
+    """Timestamp as datetime in the local timezone"""
+    return dt.datetime.fromtimestamp(value, tz=dt.datetime.now(dt.timezone.utc).astimezone().tzinfo)
+
+
+def format_counter(number: int, width: int) -> str:
+    """Format counter number, zero padded to width of the original counter string"""
+    return f"{number:0{width}d}"
+
+
+@dc.dataclass(slots=True)
+class Header:
     task_counter: str
     identifier: str
 
+    def to_dict(self) -> JsonDict:
+        return {"task_counter": self.task_counter, "identifier": self.identifier}
+
+    @staticmethod
+    def from_dict(data: JsonDict) -> Header:
+        return Header(data["task_counter"], data["identifier"])
+
     def ser(self) -> t.List[str]:
         return [
             HEADER_BEGIN,
@@ -48,8 +69,8 @@ class Header(dj.DataClassJsonMixin):
         ]
 
 
-@dc.dataclass
-class DeprecatedSection(dj.DataClassJsonMixin):
+@dc.dataclass(slots=True)
+class DeprecatedSection:
     """Exists only for migration of old data"""
 
     identifier: str | None
@@ -57,6 +78,20 @@ class DeprecatedSection(dj.DataClassJsonMixin):
     level: int
     description: t.List[str] = dc.field(default_factory=lambda: [])
 
+    def to_dict(self) -> JsonDict:
+        return {
+            "identifier": self.identifier,
+            "title": self.title,
+            "level": self.level,
+            "description": self.description,
+        }
+
+    @staticmethod
+    def from_dict(data: JsonDict) -> DeprecatedSection:
+        return DeprecatedSection(
+            data["identifier"], data["title"], data["level"], data.get("description", [])
+        )
+
     def migrate_to_task(self, parent_section: Task, line_number: int) -> Task:
         task = parse_task_line(parent_section, self.title, line_number)
         if task is None:
@@ -81,35 +116,87 @@ class DeprecatedSection(dj.DataClassJsonMixin):
         return task
 
 
-@dc.dataclass
-class TaskRef(dj.DataClassJsonMixin):
+@dc.dataclass(slots=True)
+class TaskRef:
     task: str
     section: str
     title: str
     description: t.List[str]
     line_number: int
 
-    def ser(self) -> t.Iterable[str]:
-        yield self.title
-        if self.description:
-            yield from self.description
+    def to_dict(self) -> JsonDict:
+        return {
+            "task": self.task,
+            "section": self.section,
+            "title": self.title,
+            "description": self.description,
+            "line_number": self.line_number,
+        }
+
+    @staticmethod
+    def from_dict(data: JsonDict) -> TaskRef:
+        return TaskRef(data["task"], data["section"], data["title"], data["description"], data["line_number"])
+
+    def ser(self) -> t.List[str]:
+        return [self.title, *self.description]
 
 
-@dc.dataclass
-class Task(dj.DataClassJsonMixin):
+# Markdown heading prefixes of sections, by level.
+LEVEL_PREFIXES = ("", *("#" * level + " " for level in range(1, 16)))
+
+
+@functools.lru_cache(maxsize=4096)
+def title_words(title: str) -> t.FrozenSet[str]:
+    """Words of the title, cached as titles rarely change between serializations"""
+    return frozenset(title.split())
+
+
+@dc.dataclass(slots=True)
+class Task:
     identifier: t.Optional[str]
     state: t.Optional[str]
     related_tasks: t.List[str]
     tags: t.List[str]
-    title: str = dc.field(metadata=dj.config(field_name="content"))
+    title: str  # Stored as "content"
     section: str
     line_number: int = dc.field(default=-1)
     prefix: str = dc.field(default="")  # Originally was missing
     description: t.List[str] = dc.field(default_factory=lambda: [])
     level: t.Optional[int] = dc.field(default=None)
 
-    def ser(self) -> t.Iterable[str]:
-        used_words_in_title = set(SPACE_RE.split(self.title))
+    def to_dict(self) -> JsonDict:
+        return {
+            "identifier": self.identifier,
+            "state": self.state,
+            "related_tasks": self.related_tasks,
+            "tags": self.tags,
+            "content": self.title,
+            "section": self.section,
+            "line_number": self.line_number,
+            "prefix": self.prefix,
+            "description": self.description,
+            "level": self.level,
+        }
+
+    @staticmethod
+    def from_dict(data: JsonDict) -> Task:
+        # States, tags and sections repeat across tasks and snapshots, so they are interned.
+        state = data["state"]
+        return Task(
+            data["identifier"],
+            sys.intern(state) if state is not None else None,
+            data["related_tasks"],
+            [sys.intern(tag) for tag in data["tags"]],
+            data["content"],
+            sys.intern(data["section"]),
+            line_number=data.get("line_number", -1),
+            prefix=data.get("prefix", ""),
+            description=data.get("description", []),
+            level=data.get("level"),
+        )
+
+    def ser(self) -> t.List[str]:
+        used_words_in_title = title_words(self.title)
         prefix_tags = []
         for tag in self.tags:
             if tag in used_words_in_title:
@@ -120,25 +207,48 @@ class Task(dj.DataClassJsonMixin):
             words.append(self.identifier)
         words.extend(prefix_tags)
         words.append(self.title)
-        level = ("#" * self.level + " ") if self.level is not None and self.level > 0 else ""
-        yield level + self.prefix + " ".join(words)
-        yield from self.description
-
-
-@dc.dataclass
+        if self.level is None or self.level <= 0:
+            level = ""
+        elif self.level < len(LEVEL_PREFIXES):
+            level = LEVEL_PREFIXES[self.level]
+        else:
+            level = "#" * self.level + " "
+        return [level + self.prefix + " ".join(words), *self.description]
+
+    def same_text(self, other: Task) -> bool:
+        """True if all fields used by ser are equal, so both tasks serialize the same way"""
+        return (
+            self.title == other.title
+            and self.state == other.state
+            and self.identifier == other.identifier
+            and self.level == other.level
+            and self.prefix == other.prefix
+            and self.tags == other.tags
+            and self.description == other.description
+        )
+
+
+@dc.dataclass(slots=True)
 class FileIdentifiers:
     filename: str
     hostname: str
     username: str
 
+    def to_dict(self) -> JsonDict:
+        return {"filename": self.filename, "hostname": self.hostname, "username": self.username}
+
+    @staticmethod
+    def from_dict(data: JsonDict) -> FileIdentifiers:
+        return FileIdentifiers(data["filename"], data["hostname"], data["username"])
+
 
-@dc.dataclass
-class TodoFile(dj.DataClassJsonMixin):
+@dc.dataclass(slots=True)
+class TodoFile:
     header: Header
     file_identifiers: FileIdentifiers
     update_time_pretty: str
     update_time: dt.datetime
-    deprecated_sections: t.List[DeprecatedSection] = dc.field(metadata=dj.config(field_name="sections"))
+    deprecated_sections: t.List[DeprecatedSection]  # Stored as "sections"
     tasks: t.Dict[str, Task]
     non_id_tasks: t.List[Task]
     unmatched_lines: t.List[str]
@@ -146,16 +256,50 @@ class TodoFile(dj.DataClassJsonMixin):
     header_suffix: t.List[str] = dc.field(default_factory=lambda: [])
     task_refs: t.List[TaskRef] = dc.field(default_factory=lambda: [])
 
-    def ordered_tasks_and_refs(self) -> t.List[Task | TaskRef]:
-        tasks_or_refs: t.List[Task | TaskRef] = list(it.chain(self.tasks.values(), self.task_refs))
-        return sorted(tasks_or_refs, key=lambda x: x.line_number)
+    def to_dict(self) -> JsonDict:
+        return {
+            "header": self.header.to_dict(),
+            "file_identifiers": self.file_identifiers.to_dict(),
+            "update_time_pretty": self.update_time_pretty,
+            "update_time": encode_datetime(self.update_time),
+            "sections": [section.to_dict() for section in self.deprecated_sections],
+            "tasks": {key: task.to_dict() for key, task in self.tasks.items()},
+            "non_id_tasks": [task.to_dict() for task in self.non_id_tasks],
+            "unmatched_lines": self.unmatched_lines,
+            "prefix": self.prefix,
+            "header_suffix": self.header_suffix,
+            "task_refs": [ref.to_dict() for ref in self.task_refs],
+        }
+
+    @staticmethod
+    def from_dict(data: JsonDict) -> TodoFile:
+        return TodoFile(
+            Header.from_dict(data["header"]),
+            FileIdentifiers.from_dict(data["file_identifiers"]),
+            data["update_time_pretty"],
+            decode_datetime(data["update_time"]),
+            [DeprecatedSection.from_dict(section) for section in data["sections"]],
+            {key: Task.from_dict(task) for key, task in data["tasks"].items()},
+            [Task.from_dict(task) for task in data["non_id_tasks"]],
+            data["unmatched_lines"],
+            data["prefix"],
+            header_suffix=data.get("header_suffix", []),
+            task_refs=[TaskRef.from_dict(ref) for ref in data.get("task_refs", [])],
+        )
+
+    def ordered_tasks_and_refs(self) -> t.Iterator[Task | TaskRef]:
+        # Refs are already in line order, and tasks mostly are, so sorting each is close to linear.
+        # On equal line numbers, tasks come before refs.
+        key = operator.attrgetter("line_number")
+        tasks: t.List[Task | TaskRef] = sorted(self.tasks.values(), key=key)
+        refs: t.List[Task | TaskRef] = sorted(self.task_refs, key=key)
+        return heapq.merge(tasks, refs, key=key)
 
-    def ser(self) -> t.Iterable[str]:
-        yield from self.prefix
-        yield from self.header.ser()
-        yield from self.header_suffix
+    def ser(self) -> t.List[str]:
+        out = [*self.prefix, *self.header.ser(), *self.header_suffix]
         for line in self.ordered_tasks_and_refs():
-            yield from line.ser()
+            out.extend(line.ser())
+        return out
 
     def resolve_issues(self) -> bool:
         """Resolve any possible issues after parsing file from the user."""
@@ -171,6 +315,8 @@ class TodoFile(dj.DataClassJsonMixin):
 
     def _resolve_task_refs(self) -> bool:
         updated = False
+        # All refs are resolved in the same update.
+        update_line = f"Updated at {dt.datetime.now().replace(microsecond=0).isoformat()}"
         for ref in self.task_refs:
             task = self.tasks.get(ref.task)
             if task is None:
@@ -178,12 +324,11 @@ class TodoFile(dj.DataClassJsonMixin):
                     ref.title = ref.title + " !<ERR>"
                     updated = True
                 continue
-            if "".join(ref.description).strip() != "":
+            if any(line and not line.isspace() for line in ref.description):
                 updated = True
                 if task.description:
                     task.description.append("")
-                updatetime = dt.datetime.now().replace(microsecond=0)
-                task.description.append(f"Updated at {updatetime.isoformat()}")
+                task.description.append(update_line)
                 task.description.extend(ref.description)
             ref.description = []
             new_title = f"@{task.identifier} {task.title}"
@@ -195,17 +340,21 @@ class TodoFile(dj.DataClassJsonMixin):
     def _add_missing_ids(self) -> bool:
         """Add missing ids into sections and tasks. Return true if this was done for any sections"""
         updated = False
+        counter = int(self.header.task_counter)
+        width = len(self.header.task_counter)
         for section in self.deprecated_sections:
             if section.identifier is None:
-                self.header.task_counter = increase_counter(self.header.task_counter)
-                section.identifier = f"t{self.header.task_counter}"
+                counter += 1
+                section.identifier = f"t{format_counter(counter, width)}"
                 updated = True
         for task in self.non_id_tasks:
-            self.header.task_counter = increase_counter(self.header.task_counter)
-            task.identifier = f"t{self.header.task_counter}"
+            counter += 1
+            task.identifier = f"t{format_counter(counter, width)}"
             assert task.identifier not in self.tasks
             self.tasks[task.identifier] = task
             updated = True
+        if updated:
+            self.header.task_counter = format_counter(counter, width)
         self.non_id_tasks = []
         return updated
 
@@ -214,9 +363,12 @@ class TodoFile(dj.DataClassJsonMixin):
         section_stack = SectionStack()
         # When migrating, we need to assign numbers to sections
         virtual_line_counter = 1
+        # Only tasks without line number are renumbered, others need not be indexed.
+        pending = [task for task in self.tasks.values() if task.line_number < 0]
         tasks_to_sections: t.Dict[str | None, t.List[Task]] = {}
-        for task in self.tasks.values():
-            tasks_to_sections.setdefault(task.section, []).append(task)
+        if self.deprecated_sections:
+            for task in pending:
+                tasks_to_sections.setdefault(task.section, []).append(task)
         for old_section in self.deprecated_sections:
             previous_section = section_stack.get_parent(old_section.level)
             section = old_section.migrate_to_task(previous_section, virtual_line_counter)
@@ -235,7 +387,7 @@ class TodoFile(dj.DataClassJsonMixin):
                 raise Exception(f"There is section no identifier")
             self.tasks[section.identifier] = section
             updated = True
-        for t in self.tasks.values():
+        for t in pending:
             if t.line_number < 0:
                 t.line_number = virtual_line_counter
                 virtual_line_counter += 1
@@ -243,33 +395,40 @@ class TodoFile(dj.DataClassJsonMixin):
         self.deprecated_sections = []
         return updated
 
-    def diff(self, other: TodoFile) -> DiffFile:
+    def diff(self, other: TodoFile, parallel: bool = False) -> DiffFile:
         # Basically -- find tasks that changed
         tasks: t.Dict[str, DiffTask] = {}
+        # Old and new text of each diff task, diffs are filled in at the end.
+        texts: t.List[t.Tuple[str, str]] = []
         used_tasks = set()
+        # Each task is serialized at most once, tasks with unchanged fields are not serialized at all.
         for task in self.tasks.values():
             if task.identifier is None:
                 # TODO
                 continue
             used_tasks.add(task.identifier)
-            task_str = "\n".join(task.ser())
             o = other.tasks.get(task.identifier)
+            if o is not None and task.same_text(o):
+                continue
+            task_str = "\n".join(task.ser())
             if o is None:
                 tasks[task.identifier] = DiffTask(
-                    "\n".join(aln.pretty_alignment(aln.align_texts("", task_str))),
+                    "",
                     task.line_number,
                     old_section=None,
                     new_section=task.section,
                 )
+                texts.append(("", task_str))
             else:
                 o_str = "\n".join(o.ser())
                 if task_str != o_str:
                     tasks[task.identifier] = DiffTask(
-                        "\n".join(aln.pretty_alignment(aln.align_texts(o_str, task_str))),
+                        "",
                         task.line_number,
                         old_section=o.section,
                         new_section=task.section,
                     )
+                    texts.append((o_str, task_str))
 
         for task in other.tasks.values():
             if task.identifier is None:
@@ -278,18 +437,34 @@ class TodoFile(dj.DataClassJsonMixin):
                 continue
             task_str = "\n".join(task.ser())
             tasks[task.identifier] = DiffTask(
-                "\n".join(aln.pretty_alignment(aln.align_texts(task_str, ""))),
+                "",
                 task.line_number,
                 old_section=task.section,
                 new_section=None,
             )
+            texts.append((task_str, ""))
+        for diff_task, str_diff in zip(tasks.values(), pretty_diffs(texts, parallel), strict=True):
+            diff_task.str_diff = str_diff
         # TODO: Do something / order with the sections
 
         result = DiffFile(diff_tasks=tasks, sections=self.tasks, old_sections=other.tasks)
         return result
 
 
-@dc.dataclass
+def pretty_diff(old_text: str, new_text: str) -> str:
+    return "\n".join(aln.pretty_alignment(aln.align_texts(old_text, new_text)))
+
+
+def pretty_diffs(texts: t.List[t.Tuple[str, str]], parallel: bool = False) -> t.List[str]:
+    """Diffs of (old, new) text pairs, computed in a process pool if `parallel`"""
+    if not parallel or len(texts) < 2:
+        return [pretty_diff(old_text, new_text) for old_text, new_text in texts]
+    old_texts, new_texts = zip(*texts)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        return list(executor.map(pretty_diff, old_texts, new_texts))
+
+
+@dc.dataclass(slots=True)
 class DiffTask:
     str_diff: str
     line_number: int
@@ -297,21 +472,23 @@ class DiffTask:
     new_section: str | None
 
 
-@dc.dataclass
-class DiffFile(dj.DataClassJsonMixin):
+@dc.dataclass(slots=True)
+class DiffFile:
     diff_tasks: t.Dict[str, DiffTask]
     sections: t.Dict[str, Task]
     old_sections: t.Dict[str, Task]
 
     def ser(self) -> t.Iterable[str]:
-        section_order = {key: section.line_number for key, section in self.sections.items()}
         unprinted_sections = {k: v for k, v in self.sections.items() if k not in self.diff_tasks}
+        # Section lines are emitted as one string per section, each line styled on its own.
+        bold_line_separator = f"{Style.reset}\n{Style.bold}"
         for task in sorted(
             self.diff_tasks.values(),
             key=lambda x: x.line_number,
         ):
+            # Printed sections are removed, so the walk up stops at the first printed ancestor and each
+            # section is visited once over all tasks.
             section = unprinted_sections.get(task.new_section or task.old_section or "")
-            level = 1 << 47
             sections: t.List[Task] = []
             while section is not None:
                 sections.append(section)
@@ -319,7 +496,7 @@ class DiffFile(dj.DataClassJsonMixin):
                     del unprinted_sections[section.identifier]
                 section = unprinted_sections.get(section.section)
             for section in reversed(sections):
-                yield from (f"{Style.bold}{x}{Style.reset}" for x in section.ser())
+                yield f"{Style.bold}{bold_line_separator.join(section.ser())}{Style.reset}"
             if (
                 task.new_section is not None
                 and task.old_section is not None
@@ -336,31 +513,24 @@ class DiffFile(dj.DataClassJsonMixin):
 SECTION_LINE_RE = re.compile("##*[ \t]")
 
 
-def til_sectionlines(lines: mit.peekable[t.Tuple[int, str]]) -> t.List[t.Tuple[int, str]]:
-    out: t.List[t.Tuple[int, str]] = []
-    while (x_ := lines.peek(None)) is not None:
-        n, l = x_
-        x: str = l.rstrip()
-        if SECTION_LINE_RE.match(x) is not None:
-            return out
-        out.append(next(lines))
-    return out
+def til_sectionlines(lines: t.List[t.Tuple[int, str]], index: int) -> t.Tuple[t.List[t.Tuple[int, str]], int]:
+    """Lines from index until next section line, and index of the section line (or end of lines)"""
+    end = index
+    n_lines = len(lines)
+    section_match = SECTION_LINE_RE.match
+    while end < n_lines and section_match(lines[end][1].rstrip()) is None:
+        end += 1
+    return lines[index:end], end
 
 
 def parse_header(
     lines: t.List[t.Tuple[int, str]],
 ) -> t.Tuple[Header | None, t.List[t.Tuple[int, str]], t.List[t.Tuple[int, str]]]:
     index = 0
-    prefix = []
-    suffix = []
-    header = None
+    prefix: t.List[t.Tuple[int, str]] = []
     while index < len(lines):
-        if header is None:
-            if (
-                lines[index][1].strip() == HEADER_BEGIN
-                and index + 4 < len(lines)
-                and lines[index + 4][1].strip() == HEADER_END
-            ):
+        if lines[index][1].strip() == HEADER_BEGIN:
+            if index + 4 < len(lines) and lines[index + 4][1].strip() == HEADER_END:
                 # OLD format, with section counter, we just validate it
                 task_counter = lines[index + 1][1].strip()
                 section_counter = lines[index + 2][1].strip()
@@ -370,14 +540,8 @@ def parse_header(
                     and COUNTER_RE.fullmatch(section_counter) is not None
                     and UUID_RE.fullmatch(identifier) is not None
                 ):
-                    header = Header(task_counter, identifier)
-                    index += 5
-                    continue
-            if (
-                lines[index][1].strip() == HEADER_BEGIN
-                and index + 3 < len(lines)
-                and lines[index + 3][1].strip() == HEADER_END
-            ):
+                    return Header(task_counter, identifier), prefix, lines[index + 5 :]
+            if index + 3 < len(lines) and lines[index + 3][1].strip() == HEADER_END:
                 # New format, without section counter
                 task_counter = lines[index + 1][1].strip()
                 identifier = lines[index + 2][1].strip()
@@ -385,16 +549,10 @@ def parse_header(
                     COUNTER_RE.fullmatch(task_counter) is not None
                     and UUID_RE.fullmatch(identifier) is not None
                 ):
-                    header = Header(task_counter, identifier)
-                    index += 4
-                    continue
-
-        if header is None:
-            prefix.append(lines[index])
-        else:
-            suffix.append(lines[index])
+                    return Header(task_counter, identifier), prefix, lines[index + 4 :]
+        prefix.append(lines[index])
         index += 1
-    return header, prefix, suffix
+    return None, prefix, []
 
 
 class SectionStack:
@@ -413,10 +571,7 @@ class SectionStack:
         self.stack.append(section)
 
 
-def parse_section_line(section_stack: SectionStack, lines: mit.peekable[t.Tuple[int, str]]) -> None | Task:
-    line_with_index: t.Tuple[int, str] | None = next(lines, None)
-    if line_with_index is None:
-        return None
+def parse_section_line(section_stack: SectionStack, line_with_index: t.Tuple[int, str]) -> Task:
     line_number, line = line_with_index
     line = line.strip()
     title_line = line.lstrip("#")
@@ -435,28 +590,47 @@ def parse_section_line(section_stack: SectionStack, lines: mit.peekable[t.Tuple[
     return task
 
 
+def match_task_line(line: str) -> None | t.Tuple[str, str, int]:
+    """
+    Split line into prefix, state and offset of the rest, like
+    `^(?P<prefix>[ *-]*)(?P<state>\[[^]]*\])(?P<rest>.*)$`
+    """
+    state_start = len(line) - len(line.lstrip(" *-"))
+    if not line.startswith("[", state_start):
+        return None
+    state_end = line.find("]", state_start + 1) + 1
+    if state_end == 0:
+        return None
+    newline = line.find("\n", state_end)
+    if newline >= 0 and newline != len(line) - 1:
+        return None
+    return line[:state_start], line[state_start:state_end], state_end
+
+
 def parse_task_line(section: Task, line: str, line_number: int) -> None | Task:
     raw_task = line.rstrip()
-    match = TASK_LINE_RE.match(raw_task)
+    match = match_task_line(raw_task)
     if match is None:
         return None
-    state: str = match.group("state")
-    rest: str = match.group("rest").strip()
+    task_prefix, state, rest_start = match
     identifier: None | str = None
     skipping = True
     words = []
     task_ids: t.List[str] = []
     tags = []
-    for word in SPACE_RE.split(rest):
-        if ID_RE.fullmatch(word) is not None:
+    # Words are matched in place, without copying the rest of the line.
+    for word_match in WORD_RE.finditer(raw_task, rest_start):
+        word = word_match.group()
+        kind = word_match.lastgroup
+        if kind == "id":
             if identifier is None:
                 identifier = word
             else:
                 task_ids.append(word)
             if not skipping:
                 words.append(word)
-        elif TAG_RE.fullmatch(word) is not None:
-            tags.append(word)
+        elif kind == "tag":
+            tags.append(sys.intern(word))
             if not skipping:
                 words.append(word)
         else:
@@ -464,18 +638,21 @@ def parse_task_line(section: Task, line: str, line_number: int) -> None | Task:
             words.append(word)
     return Task(
         identifier,
-        state,
+        sys.intern(state),
         task_ids,
         tags,
         " ".join(words),
         section.identifier or section.title,
-        prefix=match.group("prefix"),
+        prefix=task_prefix,
         line_number=line_number,
     )
 
 
 def parse_ref_task_line(section: Task, line: str, line_number: int) -> None | TaskRef:
     raw_task = line.rstrip()
+    # Cheap rejection of the common case, so only ref lines go through the regex.
+    if not raw_task.lstrip().startswith("@"):
+        return None
     match = REF_LINE_RE.match(raw_task)
     if match is None:
         return None
@@ -484,45 +661,52 @@ def parse_ref_task_line(section: Task, line: str, line_number: int) -> None | Ta
 
 
 # Note: s is used only for historic purposes, where tasks and sections used different counter
-ID_RE = re.compile(r"(s|t)[0-9][0-9]*")
-TASK_LINE_RE = re.compile(r"^(?P<prefix>[ *-]*)(?P<state>\[[^]]*\])(?P<rest>.*)$")
-TAG_RE = re.compile(r"#[-a-zA-Z_0-9]*")
 REF_LINE_RE = re.compile(r"^\s*@(?P<task>(s|t)[0-9][0-9]*)(?P<title>\b.*)")
-SPACE_RE = re.compile(r"\s\s*")
+# Whitespace separated words, classified as whole word being a task identifier, a tag or anything else.
+WORD_RE = re.compile(r"(?P<id>(s|t)[0-9][0-9]*(?!\S))|(?P<tag>#[-a-zA-Z_0-9]*(?!\S))|(?P<word>\S+)")
 
 
-def parse(lines: mit.peekable[t.Tuple[int, str]], file_identifiers: FileIdentifiers) -> None | TodoFile:
-    header, header_prefix, header_suffix = parse_header(til_sectionlines(lines))
+def parse(lines: t.List[t.Tuple[int, str]], file_identifiers: FileIdentifiers) -> None | TodoFile:
+    """Parse numbered lines of the file, without line endings"""
+    header_lines, index = til_sectionlines(lines, 0)
+    header, header_prefix, header_suffix = parse_header(header_lines)
     if header is None:
         return None
     tasks = {}
     non_id_tasks = []
     task_refs = []
     section_stack = SectionStack()
-    while (section := parse_section_line(section_stack, lines)) is not None:
+    word_finditer = WORD_RE.finditer
+    while index < len(lines):
+        section = parse_section_line(section_stack, lines[index])
         if section.identifier is None:
             non_id_tasks.append(section)
         else:
             tasks[section.identifier] = section
-        raw_tasks = til_sectionlines(lines)
+        raw_tasks, index = til_sectionlines(lines, index + 1)
         last_task_or_ref: None | Task | TaskRef = None
+        # Tags of last_task_or_ref (if it's a task), for membership checks.
+        last_tags: t.Set[str] = set()
         for raw_task in raw_tasks:
             task_or_ref = parse_ref_task_line(section, raw_task[1], raw_task[0]) or parse_task_line(
                 section, raw_task[1], raw_task[0]
             )
             if task_or_ref is None:
-                stripped_line = raw_task[1].rstrip("\n")
+                description_line = raw_task[1]
                 if last_task_or_ref is not None:
-                    last_task_or_ref.description.append(stripped_line)
-                    if isinstance(last_task_or_ref, Task):
-                        for word in SPACE_RE.split(stripped_line):
-                            if TAG_RE.fullmatch(word) is not None and word not in last_task_or_ref.tags:
-                                last_task_or_ref.tags.append(word)
+                    last_task_or_ref.description.append(description_line)
+                    if isinstance(last_task_or_ref, Task) and "#" in description_line:
+                        for word_match in word_finditer(description_line):
+                            word = word_match.group()
+                            if word_match.lastgroup == "tag" and word not in last_tags:
+                                last_task_or_ref.tags.append(sys.intern(word))
+                                last_tags.add(word)
                 else:
-                    section.description.append(stripped_line)
+                    section.description.append(description_line)
                 continue
             last_task_or_ref = task_or_ref
             if isinstance(task_or_ref, Task):
+                last_tags = set(task_or_ref.tags)
                 if task_or_ref.identifier is None:
                     non_id_tasks.append(task_or_ref)
                 else:
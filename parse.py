@@ -3,15 +3,15 @@
 import argparse
 import os
 
-from tasks import handle_file
+from tasks import handle_files
 
 
 def main() -> None:
     db_file = f"{os.path.dirname(os.path.abspath(__file__))}/tasks.jsonl"
     parser = argparse.ArgumentParser()
-    parser.add_argument("file")
+    parser.add_argument("file", nargs="+")
     args = parser.parse_args()
-    handle_file(args.file, db_file)
+    handle_files(args.file, db_file)
 
 
 if __name__ == "__main__":
@@ -1,46 +1,127 @@
 """Parse tasks, add ids and store it to DB"""
 
 import argparse
+import contextlib
 import datetime
 import dataclasses
 import getpass
 import json
 import os
 import platform
+import sys
 import typing as t
 
 from colored import Fore, Style
-import dataclasses_json as dj
-import dateparser
-import more_itertools as mit
 
 import alignment as aln
-from datastructures import FileIdentifiers, parse, TodoFile, Task, DiffTask, DiffFile
+from datastructures import (
+    FileIdentifiers,
+    parse,
+    TodoFile,
+    Task,
+    DiffTask,
+    DiffFile,
+    JsonDict,
+    JSON_ENCODER,
+    decode_datetime,
+)
 
 
 def load_file(filename: str) -> None | TodoFile:
     with open(filename, "r", encoding="utf-8") as f:
-        return parse(
-            mit.peekable(enumerate(f)),
-            FileIdentifiers(
-                os.path.abspath(filename),
-                platform.node(),
-                getpass.getuser(),
-            ),
-        )
+        # Newlines are removed here once, like in lines coming from the LSP
+        lines = f.read().split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return parse(
+        list(enumerate(lines)),
+        FileIdentifiers(
+            os.path.abspath(filename),
+            platform.node(),
+            getpass.getuser(),
+        ),
+    )
 
 
-def handle_file(filename: str, db_file: str) -> None:
+def update_file(filename: str) -> None | TodoFile:
+    """Parse file and write it back if ids or refs were updated"""
     td = load_file(filename)
     if td is None:
         print("Not TODO file")
-        return
+        return None
     if td.resolve_issues():
         with open(filename, "w", encoding="utf-8") as f:
-            for line in td.ser():
-                print(line, file=f)
-    with open(db_file, "a", encoding="utf-8") as f:
-        print(td.to_json(ensure_ascii=False), file=f)
+            f.writelines(f"{line}\n" for line in td.ser())
+    return td
+
+
+# Fields that differ between DB records even if the file did not change.
+UPDATE_FIELDS = ("update_time", "update_time_pretty")
+
+
+def db_lines_backwards(db: t.BinaryIO) -> t.Iterator[bytes]:
+    """Non-empty lines of the DB from the last one, read in chunks from the end of the file"""
+    position = db.seek(0, os.SEEK_END)
+    # Start of the line that continues in chunks after the current one
+    tail = b""
+    while position > 0:
+        start = max(0, position - (1 << 16))
+        db.seek(start)
+        lines = (db.read(position - start) + tail).split(b"\n")
+        tail = lines[0]
+        yield from (line for line in reversed(lines[1:]) if line)
+        position = start
+    if tail:
+        yield tail
+
+
+def last_file_record(db: t.BinaryIO, file_identifiers: JsonDict) -> None | JsonDict:
+    """Last DB record of the file, searched backwards from the end of the DB"""
+    # Only lines containing the identifiers verbatim are decoded. Records written with different
+    # encoding are not found, so the file is stored again.
+    key = f'"file_identifiers": {JSON_ENCODER.encode(file_identifiers)}'.encode("utf-8")
+    for line in db_lines_backwards(db):
+        if key not in line:
+            continue
+        try:
+            record: JsonDict = json.loads(line)
+        except ValueError:
+            return None
+        if record.get("file_identifiers") == file_identifiers:
+            return record
+    return None
+
+
+def is_last_file_record(db: t.BinaryIO, record: JsonDict) -> bool:
+    """True if record differs from the last DB record of the same file only in update time"""
+    last = last_file_record(db, record["file_identifiers"])
+    if last is None:
+        return False
+    for key in UPDATE_FIELDS:
+        last[key] = record[key]
+    return last == record
+
+
+def handle_file(filename: str, db_file: str) -> None:
+    handle_files([filename], db_file)
+
+
+def handle_files(filenames: t.List[str], db_file: str) -> None:
+    """Update files and store them in DB, which is opened only once (and only if there is a TODO file).
+    Files that did not change since their last DB record are not stored again."""
+    with contextlib.ExitStack() as stack:
+        db: None | t.BinaryIO = None
+        for filename in filenames:
+            td = update_file(filename)
+            if td is None:
+                continue
+            if db is None:
+                db = stack.enter_context(open(db_file, "a+b"))
+            record = td.to_dict()
+            if is_last_file_record(db, record):
+                continue
+            # Append mode, written at the end regardless of the position after reading
+            db.write(f"{JSON_ENCODER.encode(record)}\n".encode("utf-8"))
 
 
 def debug_file(filename: str) -> None:
@@ -49,81 +130,102 @@ def debug_file(filename: str) -> None:
         print("Not TODO file")
         return
     td.resolve_issues()
-    for line in td.ser():
-        print(line)
+    sys.stdout.writelines(f"{line}\n" for line in td.ser())
 
 
-@dataclasses.dataclass
-class TodoFileSkeleton(dj.DataClassJsonMixin):
+@dataclasses.dataclass(slots=True)
+class TodoFileSkeleton:
     update_time: datetime.datetime
 
+    @staticmethod
+    def from_dict(data: JsonDict) -> "TodoFileSkeleton":
+        return TodoFileSkeleton(decode_datetime(data["update_time"]))
 
-def diff(since: datetime.datetime, until: datetime.datetime, db_file: str) -> None:
-    state_at_beginning_of_period: None | t.Tuple[TodoFileSkeleton, str] = None
-    state_at_end_of_period: None | t.Tuple[TodoFileSkeleton, str] = None
+
+def diff(since: datetime.datetime, until: datetime.datetime, db_file: str, parallel: bool = False) -> None:
+    states = states_in_period(since, until, db_file)
+    if states is None:
+        print("Unable to find any files matching your description")
+        return
+    start = TodoFile.from_dict(states[0]).migrate()
+    end = TodoFile.from_dict(states[1]).migrate()
+    sys.stdout.writelines(f"{line}\n" for line in end.diff(start, parallel).ser())
+
+
+def states_in_period(
+    since: datetime.datetime, until: datetime.datetime, db_file: str
+) -> None | t.Tuple[JsonDict, JsonDict]:
+    """Last DB records at the beginning and at the end of the period"""
+    # Only update times are needed to pick the two states, compare them as raw timestamps.
+    since_timestamp = since.timestamp()
+    until_timestamp = until.timestamp()
+    state_at_beginning_of_period: None | t.Tuple[float, str] = None
+    state_at_end_of_period: None | t.Tuple[float, str] = None
     with open(db_file, "r", encoding="utf-8") as f:
         for line in f:
-            todo = TodoFileSkeleton.from_json(line)
-            if todo.update_time <= since:
-                if (
-                    state_at_beginning_of_period is None
-                    or state_at_beginning_of_period[0].update_time < todo.update_time
-                ):
-                    state_at_beginning_of_period = (todo, line)
-            if todo.update_time <= until:
-                if state_at_end_of_period is None or state_at_end_of_period[0].update_time < todo.update_time:
-                    state_at_end_of_period = (todo, line)
+            update_time: float = json.loads(line)["update_time"]
+            if update_time <= since_timestamp:
+                if state_at_beginning_of_period is None or state_at_beginning_of_period[0] < update_time:
+                    state_at_beginning_of_period = (update_time, line)
+            if update_time <= until_timestamp:
+                if state_at_end_of_period is None or state_at_end_of_period[0] < update_time:
+                    state_at_end_of_period = (update_time, line)
     if state_at_beginning_of_period is None or state_at_end_of_period is None:
-        print("Unable to find any files matching your description")
-        return
-    start = TodoFile.from_json(state_at_beginning_of_period[1]).migrate()
-    end = TodoFile.from_json(state_at_end_of_period[1]).migrate()
-    for line in end.diff(start).ser():
-        print(line)
+        return None
+    return json.loads(state_at_beginning_of_period[1]), json.loads(state_at_end_of_period[1])
 
 
 def parse_date(x: str) -> datetime.datetime | None:
+    # dateparser takes most of the startup time, and only diff command needs it.
+    # pylint: disable=import-outside-toplevel
+    import dateparser
+
     return dateparser.parse(x, settings={"RETURN_AS_TIMEZONE_AWARE": True})
 
 
 def history(task_id: str, db_file: str) -> None:
-    hist: t.List[t.Tuple[TodoFileSkeleton, None | Task, str]] = []
+    # Lines are decoded only if they can contain the task (task id is written verbatim in JSON if it does not
+    # need escaping), or if they can mark its removal.
+    task_key = json.dumps(task_id)
+    key_is_verbatim = task_key[1:-1] == task_id
+    prev_text = None
+    prev_task: None | Task = None
+    prev_todo: None | TodoFile = None
     with open(db_file, "r", encoding="utf-8") as f:
         saw_task = False
         for line in f:
+            if key_is_verbatim and not saw_task and task_key not in line:
+                continue
             data = json.loads(line)
-            todo = TodoFileSkeleton.from_json(line)
-            task = data.get("tasks", {}).get(task_id)
-            if task is not None:
+            task_data = data.get("tasks", {}).get(task_id)
+            task: None | Task = None
+            if task_data is not None:
                 saw_task = True
-                hist.append((todo, Task.from_dict(task), line))
+                task = Task.from_dict(task_data)
+            elif saw_task:
+                saw_task = False
             else:
-                if saw_task:
-                    hist.append((todo, None, line))
-                    saw_task = False
-    prev_text = None
-    prev_task: None | Task = None
-    prev_todo: None | TodoFile = None
-    for todo, task, line in hist:
-        text = "\n".join(task.ser())
-        if text != prev_text or task.section != (prev_task.section if prev_task is not None else None):
-            todo_file = TodoFile.from_json(line).migrate()
-            diff_task = DiffTask(
-                "\n".join(aln.pretty_alignment(aln.align_texts(prev_text or "", text))),
-                task.line_number,
-                old_section=prev_task.section if prev_task is not None else None,
-                new_section=task.section,
-            )
-            diff_file = DiffFile(
-                diff_tasks={task.identifier: diff_task},
-                sections=todo_file.tasks,
-                old_sections=prev_todo.tasks if prev_todo is not None else {},
-            )
-            print(f"{Fore.light_blue}{Style.bold}Updated at {todo.update_time}{Style.reset}")
-            print("\n".join(diff_file.ser()))
-            prev_task = task
-            prev_text = text
-            prev_todo = todo_file
+                continue
+            todo = TodoFileSkeleton.from_dict(data)
+            text = "\n".join(task.ser())
+            if text != prev_text or task.section != (prev_task.section if prev_task is not None else None):
+                todo_file = TodoFile.from_dict(data).migrate()
+                diff_task = DiffTask(
+                    "\n".join(aln.pretty_alignment(aln.align_texts(prev_text or "", text, adaptive=True))),
+                    task.line_number,
+                    old_section=prev_task.section if prev_task is not None else None,
+                    new_section=task.section,
+                )
+                diff_file = DiffFile(
+                    diff_tasks={task.identifier: diff_task},
+                    sections=todo_file.tasks,
+                    old_sections=prev_todo.tasks if prev_todo is not None else {},
+                )
+                print(f"{Fore.light_blue}{Style.bold}Updated at {todo.update_time}{Style.reset}")
+                print("\n".join(diff_file.ser()))
+                prev_task = task
+                prev_text = text
+                prev_todo = todo_file
 
 
 def main() -> None:
@@ -134,8 +236,8 @@ def main() -> None:
     update_and_store = subparsers.add_parser(
         "update-and-store", help="Update IDs in the file and then store it in DB"
     )
-    update_and_store.add_argument("--file")
-    update_and_store.set_defaults(func=lambda args: handle_file(args.file, db_file))
+    update_and_store.add_argument("--file", nargs="+")
+    update_and_store.set_defaults(func=lambda args: handle_files(args.file, db_file))
 
     debug = subparsers.add_parser("debug", help="Parse file and print it")
     debug.add_argument("--file")
@@ -144,7 +246,12 @@ def main() -> None:
     diff_c = subparsers.add_parser("diff", help="Show difference in given time period")
     diff_c.add_argument("--since", type=parse_date, default="3 weeks ago")
     diff_c.add_argument("--until", type=parse_date, default="now")
-    diff_c.set_defaults(func=lambda args: diff(args.since, args.until, db_file))
+    diff_c.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Compute diffs of tasks in a process pool, for many large tasks",
+    )
+    diff_c.set_defaults(func=lambda args: diff(args.since, args.until, db_file, args.parallel))
 
     history_c = subparsers.add_parser("history", help="Show history of given task")
     history_c.add_argument("--task", type=str, required=True)
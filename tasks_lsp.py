@@ -1,24 +1,66 @@
 import sys
+import dataclasses as dc
 import json
 import typing as t
 
-import more_itertools as mit
-
 from datastructures import parse, FileIdentifiers, Task
 from dummy import DummyWriter
 
 
-documents: t.Dict[str, t.Union[str, t.List[str]]] = {}
+documents: t.Dict[str, t.List[str]] = {}
+# Documents changed since they were last parsed.
+changed_documents: t.Set[str] = set()
 last_tasks: t.Dict[str, t.List[Task]] = {}
 
 
+@dc.dataclass(slots=True)
+class CompletionIndex:
+    """Tasks that can be completed, with lowercased titles and index of title trigrams"""
+
+    source: t.List[Task]
+    tasks: t.List[Task]
+    titles: t.List[str]
+    # Trigram -> indices of titles containing it, in order
+    trigrams: t.Dict[str, t.List[int]]
+
+    @staticmethod
+    def from_tasks(source: t.List[Task]) -> "CompletionIndex":
+        tasks = [task for task in source if task.identifier is not None and task.state != "[x]"]
+        titles = [task.title.lower() for task in tasks]
+        trigrams: t.Dict[str, t.List[int]] = {}
+        for index, title in enumerate(titles):
+            for trigram in {title[i : i + 3] for i in range(len(title) - 2)}:
+                trigrams.setdefault(trigram, []).append(index)
+        return CompletionIndex(source, tasks, titles, trigrams)
+
+    def matching(self, query: str) -> t.List[Task]:
+        """Tasks with lowercased title containing the query, in order"""
+        if len(query) < 3:
+            return [task for task, title in zip(self.tasks, self.titles) if query in title]
+        # Every match contains all trigrams of the query, so the rarest one gives the fewest candidates.
+        postings = [self.trigrams.get(query[i : i + 3], []) for i in range(len(query) - 2)]
+        return [self.tasks[index] for index in min(postings, key=len) if query in self.titles[index]]
+
+
+completion_indexes: t.Dict[str, CompletionIndex] = {}
+
+
+def get_completion_index(uri: str, tasks: t.List[Task]) -> CompletionIndex:
+    index = completion_indexes.get(uri)
+    if index is None or index.source is not tasks:
+        index = CompletionIndex.from_tasks(tasks)
+        completion_indexes[uri] = index
+    return index
+
+
 def read_msg() -> t.Optional[t.Dict[str, t.Any]]:
-    # Read message's content length and body (as per LSP spec)
-    line = sys.stdin.readline()
-    if line.startswith("Content-Length:"):
-        length = int(line.split(":")[1].strip())
-        sys.stdin.readline()  # skip empty line
-        body = sys.stdin.read(length)
+    # Read message's content length and body (as per LSP spec). Content length is in bytes, so the
+    # binary stream is used.
+    line = sys.stdin.buffer.readline()
+    if line.startswith(b"Content-Length:"):
+        length = int(line.split(b":")[1].strip())
+        sys.stdin.buffer.readline()  # skip empty line
+        body = sys.stdin.buffer.read(length)
         return t.cast(
             t.Dict[str, t.Any],
             json.loads(body),
@@ -27,9 +69,9 @@ def read_msg() -> t.Optional[t.Dict[str, t.Any]]:
 
 
 def send_msg(msg: t.Any) -> None:
-    body = json.dumps(msg)
-    sys.stdout.write(f"Content-Length: {len(body)}\r\n\r\n{body}")
-    sys.stdout.flush()
+    body = json.dumps(msg).encode("utf-8")
+    sys.stdout.buffer.write(b"Content-Length: %d\r\n\r\n%b" % (len(body), body))
+    sys.stdout.buffer.flush()
 
 
 def make_completion_item(matched_text: str, task: Task, line: int, start_char: int, end_char: int) -> t.Any:
@@ -56,11 +98,10 @@ def get_document(uri: str) -> t.Tuple[t.Optional[t.List[str]], t.List[Task]]:
     document = documents.get(uri)
     if document is None:
         return None, []
-    if isinstance(document, str):
-        splitted = document.split("\n")
-        documents[uri] = splitted
+    if uri in changed_documents:
+        changed_documents.discard(uri)
         parsed = parse(
-            mit.peekable(enumerate(document.split("\n"))),
+            list(enumerate(document)),
             FileIdentifiers("", "", ""),
         )
         if parsed is not None:
@@ -69,8 +110,8 @@ def get_document(uri: str) -> t.Tuple[t.Optional[t.List[str]], t.List[Task]]:
                 last_tasks[uri] = tasks
         else:
             tasks = []
-        return splitted, tasks
-    return t.cast(document, t.List[str]), last_tasks.get(uri, [])
+        return document, tasks
+    return document, last_tasks.get(uri, [])
 
 
 def handle_completion(f: t.TextIO, params: t.Any) -> t.Any:
@@ -80,22 +121,19 @@ def handle_completion(f: t.TextIO, params: t.Any) -> t.Any:
     document, tasks = get_document(document_uri)
     if document is None or line > len(document) or len(tasks) == 0:
         return {"isIncomplete": False, "items": []}
-    line_til_char = document[line][:character]
+    line_til_char = document[line][: code_point_index(document[line], character)]
     if "@" not in line_til_char:
         return {"isIncomplete": False, "items": []}
     _, to_suggest = line_til_char.rsplit("@", maxsplit=1)
-    tsl = to_suggest.lower()
-    relevant_tasks = [
-        task
-        for task in tasks
-        if tsl in task.title.lower() and task.identifier is not None and task.state != "[x]"
-    ]
+    # Length in UTF-16 code units, like the position.
+    to_suggest_length = len(to_suggest.encode("utf-16-le")) // 2
+    relevant_tasks = get_completion_index(document_uri, tasks).matching(to_suggest.lower())
     items = [
         make_completion_item(
             to_suggest,
             task,
             line,
-            character - len(to_suggest),
+            character - to_suggest_length,
             character,
         )
         for task in relevant_tasks
@@ -103,27 +141,81 @@ def handle_completion(f: t.TextIO, params: t.Any) -> t.Any:
     return {"isIncomplete": True, "items": items}
 
 
+def set_document(uri: str, text: str) -> None:
+    lines = text.split("\n")
+    # Documents set to the same text are not parsed again.
+    if documents.get(uri) == lines:
+        return
+    documents[uri] = lines
+    changed_documents.add(uri)
+
+
+def code_point_index(line: str, character: int) -> int:
+    """Index in the line of LSP position's character, which counts UTF-16 code units
+
+    >>> code_point_index("a\U0001f600b", 3)
+    2
+    """
+    if line.isascii():
+        return character
+    units = 0
+    for index, char in enumerate(line):
+        if units >= character:
+            return index
+        units += 2 if ord(char) > 0xFFFF else 1
+    return len(line)
+
+
+def change_position(lines: t.List[str], position: t.Any) -> t.Tuple[int, int]:
+    """Line and index in it of the position, positions after the last line are at the end of document"""
+    line: int = position["line"]
+    if line >= len(lines):
+        return len(lines) - 1, len(lines[-1])
+    return line, code_point_index(lines[line], position["character"])
+
+
+def apply_change(lines: t.List[str], change: t.Any) -> None:
+    """Apply TextDocumentContentChangeEvent to lines of the document, in place
+
+    >>> lines = ["\U0001f600 [ ] t1"]
+    >>> start, end = {"line": 0, "character": 3}, {"line": 0, "character": 6}
+    >>> apply_change(lines, {"range": {"start": start, "end": end}, "text": "[x]"})
+    >>> lines == ["\U0001f600 [x] t1"]
+    True
+    """
+    text: str = change["text"]
+    if "range" not in change:
+        lines[:] = text.split("\n")
+        return
+    start_line, start_character = change_position(lines, change["range"]["start"])
+    end_line, end_character = change_position(lines, change["range"]["end"])
+    changed = lines[start_line][:start_character] + text + lines[end_line][end_character:]
+    lines[start_line : end_line + 1] = changed.split("\n")
+
+
 def handle_did_open(params: t.Any) -> None:
-    global documents
     text_doc = params["textDocument"]
     uri = text_doc["uri"]
     text = text_doc["text"]
-    documents[uri] = text
+    set_document(uri, text)
 
 
 def handle_did_change(params: t.Any) -> None:
-    global documents
-    # For simplicity, handle full text synchronization only
+    # Incremental synchronization, changes are applied in order to lines of the document.
     uri = params["textDocument"]["uri"]
     content_changes = params["contentChanges"]
     if content_changes:
-        # Taking the full text from the first change only
-        documents[uri] = content_changes[0].get("text", documents.get(uri, ""))
+        lines = documents.setdefault(uri, [""])
+        for change in content_changes:
+            apply_change(lines, change)
+        changed_documents.add(uri)
 
 
 def lsp_loop() -> None:
     # with open("log.jsonl", "a") as f:
     with DummyWriter() as f:
+        # Messages are formatted for the log only when it's written somewhere.
+        logging = not isinstance(f, DummyWriter)
         print("start", file=f)
         while True:
             request = read_msg()
@@ -139,8 +231,9 @@ def lsp_loop() -> None:
                 f.flush()
                 handle_did_change(request["params"])
             else:
-                print(json.dumps(request, indent=2), file=f)
-                f.flush()
+                if logging:
+                    print(json.dumps(request, indent=2), file=f)
+                    f.flush()
                 if method == "initialize":
                     send_msg(
                         {
@@ -150,7 +243,7 @@ def lsp_loop() -> None:
                                 "capabilities": {
                                     "textDocumentSync": {
                                         "openClose": True,
-                                        "change": 1,  # 1 = Full text sync (use 2 for incremental if supported)
+                                        "change": 2,  # 2 = Incremental sync, only changed ranges are sent
                                     },
                                     "completionProvider": {"resolveProvider": False},
                                 },
@@ -159,7 +252,8 @@ def lsp_loop() -> None:
                     )
                 elif method == "textDocument/completion":
                     result = handle_completion(f, request.get("params", {}))
-                    print(json.dumps(result, indent=2), file=f)
+                    if logging:
+                        print(json.dumps(result, indent=2), file=f)
                     send_msg({"jsonrpc": "2.0", "id": request["id"], "result": result})
                 elif method == "shutdown":
                     send_msg({"jsonrpc": "2.0", "id": request["id"], "result": None})